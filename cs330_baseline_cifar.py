@@ -2,153 +2,478 @@ import os
 import random
 
 import torch
+import torch.distributed as dist
 import torch.nn as nn
+import torch.nn.functional as F
 import torch.optim as optim
+from torch.nn.parallel import DistributedDataParallel as DDP
 import torchvision
 from torchvision import datasets, transforms
 
 import time
 import copy
+import contextlib
 import numpy as np
 import logging
 # logging.basicConfig(format='%(asctime)s %(levelname)s %(filename)s:%(lineno)d %(message)s', level=logging.INFO)
 logging.basicConfig(format='%(asctime)s %(levelname)s %(message)s', level=logging.INFO)
 
-from resnet import resnet18
+from resnet import resnet18, ResNet, BasicBlock
 from vovnet import VovNet
 
 CIFAR10 = 'cifar10'
 FASHION_MNIST = 'fashion_nist'
 
+# Per-channel (mean, std) used to normalize the inputs on GPU.
+# CIFAR10 alternative: (0.4914, 0.4822, 0.4465), (0.2023, 0.1994, 0.2010)
+DATASET_MEAN_STD = {
+    CIFAR10: ((0.485, 0.456, 0.406), (0.229, 0.224, 0.225)),
+    FASHION_MNIST: ((0.5,), (0.5,)),
+}
 
-def set_random_seeds(random_seed=0):
+
+def set_random_seeds(random_seed=0, deterministic=False):
 
     torch.manual_seed(random_seed)
-    torch.backends.cudnn.deterministic = True
-    torch.backends.cudnn.benchmark = False
+    # The input shapes are fixed, so the cuDNN autotuner only has to pick the fastest kernels
+    # once. Use deterministic=True to reproduce a run exactly.
+    torch.backends.cudnn.deterministic = deterministic
+    torch.backends.cudnn.benchmark = not deterministic
     np.random.seed(random_seed)
     random.seed(random_seed)
 
 
+def setup_distributed():
+    """Initializes the NCCL process group when launched by torchrun.
+
+    Returns:
+        (rank, local_rank, world_size). (0, 0, 1) for a plain single process run.
+    """
+
+    if "LOCAL_RANK" not in os.environ:
+        return 0, 0, 1
+
+    local_rank = int(os.environ["LOCAL_RANK"])
+    torch.cuda.set_device(local_rank)
+    dist.init_process_group("nccl")
+
+    return dist.get_rank(), local_rank, dist.get_world_size()
+
+
+def is_main_process():
+
+    return not dist.is_initialized() or dist.get_rank() == 0
+
+
+class MemmapImageDataset(torch.utils.data.Dataset):
+    """uint8 NCHW images and int64 labels read from raw binary files through np.memmap.
+
+    Indexing with a single index or with a batch of indices (as yielded by a BatchSampler)
+    slices the memory mapped arrays, without unpickling or decoding anything.
+    """
+
+    def __init__(self, images_filepath, labels_filepath, image_shape):
+
+        self.images_filepath = images_filepath
+        self.labels = np.fromfile(labels_filepath, dtype=np.int64)
+        self.image_shape = tuple(image_shape)
+        # Opened lazily so that each DataLoader worker maps the file itself.
+        self.images = None
+
+    def __len__(self):
+        return len(self.labels)
+
+    def __getitem__(self, index):
+        if self.images is None:
+            # Copy-on-write mode makes the views writable for torch.from_numpy
+            # while never modifying the file.
+            self.images = np.memmap(self.images_filepath,
+                                    dtype=np.uint8,
+                                    mode="c",
+                                    shape=(len(self.labels), ) + self.image_shape)
+        return torch.from_numpy(self.images[index]), torch.from_numpy(
+            np.asarray(self.labels[index]))
+
+
+def load_memmap_dataset(dataset_class, train, transform, image_shape, filepath_prefix):
+    """Returns a MemmapImageDataset of a torchvision dataset.
+
+    On the first run the dataset is decoded once and written to <filepath_prefix>_u8.bin and
+    <filepath_prefix>_labels.i64.
+    """
+
+    images_filepath = filepath_prefix + "_u8.bin"
+    labels_filepath = filepath_prefix + "_labels.i64"
+
+    # A file truncated by an interrupted run does not match the number of labels.
+    is_cached = os.path.exists(images_filepath) and os.path.exists(labels_filepath)
+    if is_cached:
+        num_samples = os.path.getsize(labels_filepath) // np.dtype(np.int64).itemsize
+        is_cached = os.path.getsize(images_filepath) == num_samples * int(np.prod(image_shape))
+
+    if not is_cached:
+        dataset = dataset_class(root="data",
+                                train=train,
+                                download=True,
+                                transform=transform)
+        # Decode (and resize) every image only once.
+        images = []
+        labels = []
+        for image, label in dataset:
+            images.append(image)
+            labels.append(label)
+        images = torch.stack(images)
+        assert images.size()[1:] == image_shape
+        labels = torch.tensor(labels, dtype=torch.long)
+        # Write to temporary files first, so that the final paths only ever hold complete files.
+        images.numpy().tofile(images_filepath + ".tmp")
+        labels.numpy().tofile(labels_filepath + ".tmp")
+        os.replace(images_filepath + ".tmp", images_filepath)
+        os.replace(labels_filepath + ".tmp", labels_filepath)
+
+    return MemmapImageDataset(images_filepath=images_filepath,
+                              labels_filepath=labels_filepath,
+                              image_shape=image_shape)
+
+
 def prepare_dataloader(num_workers=8,
                        train_batch_size=128,
                        eval_batch_size=256,
-                       dataset: str=None):
+                       dataset: str=None,
+                       drop_last=False):
+    # Both datasets are memory mapped from preprocessed uint8 NCHW files, so the workers only
+    # slice memory. Augmentation and normalization are done on GPU by GPUAugment and GPUNormalize.
     if dataset == CIFAR10:
-        train_transform = transforms.Compose([
-            transforms.RandomCrop(32, padding=4),
-            transforms.RandomHorizontalFlip(),
-            transforms.ToTensor(),
-            # transforms.Normalize((0.4914, 0.4822, 0.4465), (0.2023, 0.1994, 0.2010)),
-            transforms.Normalize(mean=(0.485, 0.456, 0.406),
-                                 std=(0.229, 0.224, 0.225))
-        ])
-
-        test_transform = transforms.Compose([
-            transforms.ToTensor(),
-            # transforms.Normalize((0.4914, 0.4822, 0.4465), (0.2023, 0.1994, 0.2010)),
-            transforms.Normalize(mean=(0.485, 0.456, 0.406),
-                                 std=(0.229, 0.224, 0.225))
-        ])
-
-        train_set = torchvision.datasets.CIFAR10(root="data",
-                                                 train=True,
-                                                 download=True,
-                                                 transform=train_transform)
-        # We will use test set for validation and test in this project.
-        # Do not use test set for validation in practice!
-        test_set = torchvision.datasets.CIFAR10(root="data",
-                                                train=False,
-                                                download=True,
-                                                transform=test_transform)
+        dataset_class = torchvision.datasets.CIFAR10
+        transform = transforms.PILToTensor()
+        image_shape = (3, 32, 32)
     elif dataset == FASHION_MNIST:
-        train_transform = transforms.Compose([
+        dataset_class = torchvision.datasets.FashionMNIST
+        transform = transforms.Compose([
             transforms.Resize((32, 32)),
-            transforms.RandomHorizontalFlip(),
-            transforms.ToTensor(),
-            transforms.Normalize((0.5,), (0.5,))
+            transforms.PILToTensor()
         ])
-
-        test_transform = transforms.Compose([
-            transforms.Resize((32, 32)),
-            transforms.ToTensor(),
-            transforms.Normalize((0.5,), (0.5,))
-        ])
-        train_set = torchvision.datasets.FashionMNIST(root="data",
-                                                      train=True,
-                                                      download=True,
-                                                      transform=train_transform)
-        # We will use test set for validation and test in this project.
-        # Do not use test set for validation in practice!
-        test_set = torchvision.datasets.FashionMNIST(root="data",
-                                                     train=False,
-                                                     download=True,
-                                                     transform=test_transform)
+        image_shape = (1, 32, 32)
     else:
         raise NotImplemented()
 
-    train_sampler = torch.utils.data.RandomSampler(train_set)
+    # Only the main process writes the preprocessed files, the others wait for it.
+    if not is_main_process():
+        dist.barrier()
+    train_set = load_memmap_dataset(dataset_class=dataset_class,
+                                    train=True,
+                                    transform=transform,
+                                    image_shape=image_shape,
+                                    filepath_prefix=os.path.join("data", f"{dataset}_train"))
+    # We will use test set for validation and test in this project.
+    # Do not use test set for validation in practice!
+    test_set = load_memmap_dataset(dataset_class=dataset_class,
+                                   train=False,
+                                   transform=transform,
+                                   image_shape=image_shape,
+                                   filepath_prefix=os.path.join("data", f"{dataset}_test"))
+    if is_main_process() and dist.is_initialized():
+        dist.barrier()
+
+    # Each process of a torchrun launch only sees its own shard of the training set.
+    if dist.is_initialized():
+        train_sampler = torch.utils.data.distributed.DistributedSampler(
+            train_set, shuffle=True)
+    else:
+        train_sampler = torch.utils.data.RandomSampler(train_set)
     test_sampler = torch.utils.data.SequentialSampler(test_set)
 
-    train_loader = torch.utils.data.DataLoader(dataset=train_set,
-                                               batch_size=train_batch_size,
-                                               sampler=train_sampler,
-                                               num_workers=num_workers)
-
-    test_loader = torch.utils.data.DataLoader(dataset=test_set,
+    # Pinned host memory lets the training loop issue asynchronous (non_blocking) copies to GPU.
+    # persistent_workers and prefetch_factor are only accepted with worker processes.
+    loader_kwargs = {"num_workers": num_workers, "pin_memory": True}
+    if num_workers > 0:
+        loader_kwargs.update(persistent_workers=True, prefetch_factor=4)
+
+    # The samplers yield whole batches of indices and automatic batching is disabled, so each
+    # batch is a single tensor indexing op instead of one __getitem__ call per sample.
+    train_loader = torch.utils.data.DataLoader(
+        dataset=train_set,
+        batch_size=None,
+        sampler=torch.utils.data.BatchSampler(train_sampler,
+                                              batch_size=train_batch_size,
+                                              drop_last=drop_last),
+        **loader_kwargs)
+
+    test_loader = torch.utils.data.DataLoader(
+        dataset=test_set,
+        batch_size=None,
+        sampler=torch.utils.data.BatchSampler(test_sampler,
                                               batch_size=eval_batch_size,
-                                              sampler=test_sampler,
-                                              num_workers=num_workers)
+                                              drop_last=False),
+        **loader_kwargs)
 
     return train_loader, test_loader
 
 
-def evaluate_model(model, test_loader, device, criterion=None):
+class GPUNormalize(nn.Module):
+    """Converts uint8 images to float and normalizes them on the device they live on."""
+
+    def __init__(self, mean, std):
+
+        super(GPUNormalize, self).__init__()
+        self.register_buffer("mean", torch.tensor(mean).view(1, -1, 1, 1))
+        self.register_buffer("std", torch.tensor(std).view(1, -1, 1, 1))
+
+    def forward(self, x):
+        return x.float().div_(255.).sub_(self.mean).div_(self.std)
+
+
+class GPUAugment(nn.Module):
+    """Batched random crop with zero padding and random horizontal flip of NCHW images."""
+
+    def __init__(self, padding=4, hflip=True):
+
+        super(GPUAugment, self).__init__()
+        self.padding = padding
+        self.hflip = hflip
+
+    def forward(self, x):
+        n, c, h, w = x.size()
+
+        if self.padding > 0:
+            x = F.pad(x, (self.padding, self.padding, self.padding, self.padding))
+            # Each image gets its own crop offset. Gather the crops with advanced indexing.
+            offset_y = torch.randint(0, 2 * self.padding + 1, (n, 1), device=x.device)
+            offset_x = torch.randint(0, 2 * self.padding + 1, (n, 1), device=x.device)
+            rows = offset_y + torch.arange(h, device=x.device)
+            cols = offset_x + torch.arange(w, device=x.device)
+            x = x[torch.arange(n, device=x.device)[:, None, None, None],
+                  torch.arange(c, device=x.device)[None, :, None, None],
+                  rows[:, None, :, None],
+                  cols[:, None, None, :]]
+
+        if self.hflip:
+            flip = torch.rand(n, device=x.device) < 0.5
+            x = torch.where(flip[:, None, None, None], x.flip(3), x)
+
+        return x
+
+
+class CUDAPrefetcher(object):
+    """Wraps a DataLoader and copies the next batch to GPU on a side stream.
+
+    The host to device copy of batch N+1 overlaps with the compute on batch N. Iterating yields
+    (inputs, labels) that are already on device.
+    """
+
+    def __init__(self, loader, device):
+
+        self.loader = loader
+        self.device = device
+        self.stream = torch.cuda.Stream(device=device)
+        self.loader_iter = None
+        self.next_inputs = None
+        self.next_labels = None
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __iter__(self):
+        self.loader_iter = iter(self.loader)
+        self.preload()
+        return self
+
+    def preload(self):
+        try:
+            inputs, labels = next(self.loader_iter)
+        except StopIteration:
+            self.next_inputs = None
+            self.next_labels = None
+            return
+
+        with torch.cuda.stream(self.stream):
+            self.next_inputs = inputs.to(self.device, non_blocking=True)
+            self.next_labels = labels.to(self.device, non_blocking=True)
+
+    def __next__(self):
+        if self.next_inputs is None:
+            raise StopIteration
+
+        current_stream = torch.cuda.current_stream(self.device)
+        current_stream.wait_stream(self.stream)
+        inputs = self.next_inputs
+        labels = self.next_labels
+        # The batch was allocated on the side stream but is used on the current stream.
+        inputs.record_stream(current_stream)
+        labels.record_stream(current_stream)
+        self.preload()
+
+        return inputs, labels
+
+
+def evaluate_model(model,
+                   test_loader,
+                   device,
+                   criterion=None,
+                   use_amp=True,
+                   normalizer=None,
+                   channels_last=False):
 
     model.eval()
-    model.to(device)
+    memory_format = torch.channels_last if channels_last else torch.contiguous_format
 
-    running_loss = 0
-    running_corrects = 0
+    # Mixed precision only applies on CUDA devices.
+    amp_enabled = use_amp and device.type == "cuda"
 
-    for inputs, labels in test_loader:
+    # inference_mode is only available from PyTorch 1.9.
+    inference_mode = getattr(torch, "inference_mode", torch.no_grad)
 
-        inputs = inputs.to(device)
-        labels = labels.to(device)
+    with inference_mode():
+        # Accumulate the statistics on device to avoid a host sync per batch.
+        running_loss = torch.zeros((), device=device)
+        running_corrects = torch.zeros((), device=device, dtype=torch.long)
 
-        outputs = model(inputs)
-        _, preds = torch.max(outputs, 1)
+        for inputs, labels in test_loader:
 
-        if criterion is not None:
-            loss = criterion(outputs, labels).item()
-        else:
-            loss = 0
+            inputs = inputs.to(device, non_blocking=True)
+            labels = labels.to(device, non_blocking=True)
+            if normalizer is not None:
+                inputs = normalizer(inputs)
+            inputs = inputs.contiguous(memory_format=memory_format)
 
-        # statistics
-        running_loss += loss * inputs.size(0)
-        running_corrects += torch.sum(preds == labels.data)
+            with torch.cuda.amp.autocast(enabled=amp_enabled):
+                outputs = model(inputs)
+                preds = outputs.argmax(dim=1)
+
+                if criterion is not None:
+                    loss = criterion(outputs, labels)
+                    running_loss += loss * inputs.size(0)
+
+            # statistics
+            running_corrects += (preds == labels).sum()
 
-    eval_loss = running_loss / len(test_loader.dataset)
-    eval_accuracy = running_corrects / len(test_loader.dataset)
+    eval_loss = running_loss.item() / len(test_loader.dataset)
+    eval_accuracy = running_corrects.item() / len(test_loader.dataset)
 
     return eval_loss, eval_accuracy
 
 
+def set_frozen_batchnorm_eval(model):
+    """Puts batch normalization layers whose parameters are all frozen into eval mode."""
+
+    # Otherwise a frozen backbone would still update its BN running statistics during finetuning.
+    for module in model.modules():
+        if isinstance(module, nn.modules.batchnorm._BatchNorm):
+            params = list(module.parameters())
+            if params and not any(param.requires_grad for param in params):
+                module.eval()
+
+
+def compile_model(model):
+    """Returns a compiled forward sharing parameters with model, or model itself if torch.compile is unavailable."""
+
+    if not hasattr(torch, "compile"):
+        return model
+
+    # The input shape is fixed, so there is no need for dynamic shapes.
+    if isinstance(model, QuantizedResNet18):
+        # Only compile the FP32 body. The quant/dequant stubs stay in eager mode.
+        model_fp32 = torch.compile(model.model_fp32,
+                                   mode="max-autotune",
+                                   dynamic=False)
+        return lambda x: model.dequant(model_fp32(model.quant(x)))
+
+    return torch.compile(model, mode="max-autotune", dynamic=False)
+
+
+def capture_train_step(forward_model, criterion, optimizer, scaler, amp_enabled,
+                       static_inputs, static_labels, num_warmups=3):
+    """Captures forward + loss + backward of one training step into a CUDA graph.
+
+    Replaying the graph recomputes static_outputs, static_loss and the parameter gradients
+    from the current content of static_inputs and static_labels. The buffers of forward_model
+    (e.g. BN running statistics) are restored after the warmup iterations.
+
+    Returns:
+        (graph, static_outputs, static_loss)
+    """
+
+    saved_buffers = [buffer.clone() for buffer in forward_model.buffers()]
+
+    # Warm up on a side stream before capturing, as required by CUDA graphs.
+    stream = torch.cuda.Stream()
+    stream.wait_stream(torch.cuda.current_stream())
+    with torch.cuda.stream(stream):
+        for _ in range(num_warmups):
+            optimizer.zero_grad(set_to_none=True)
+            with torch.cuda.amp.autocast(enabled=amp_enabled, cache_enabled=False):
+                outputs = forward_model(static_inputs)
+                loss = criterion(outputs, static_labels)
+            scaler.scale(loss).backward()
+    torch.cuda.current_stream().wait_stream(stream)
+
+    # Undo the BN running statistics updates of the warmup iterations.
+    with torch.no_grad():
+        for buffer, saved_buffer in zip(forward_model.buffers(), saved_buffers):
+            buffer.copy_(saved_buffer)
+
+    # The gradients allocated during capture are the static gradients the replays write into.
+    optimizer.zero_grad(set_to_none=True)
+    graph = torch.cuda.CUDAGraph()
+    with torch.cuda.graph(graph):
+        with torch.cuda.amp.autocast(enabled=amp_enabled, cache_enabled=False):
+            static_outputs = forward_model(static_inputs)
+            static_loss = criterion(static_outputs, static_labels)
+        scaler.scale(static_loss).backward()
+
+    return graph, static_outputs, static_loss
+
+
 def train_model(model,
                 train_loader,
                 test_loader,
                 device,
                 learning_rate=1e-1,
-                num_epochs=200):
+                num_epochs=200,
+                use_amp=True,
+                normalizer=None,
+                use_compile=True,
+                channels_last=True,
+                accum_steps=1,
+                augment=None,
+                use_cuda_graph=False):
 
     # The training configurations were not carefully selected.
 
+    # The CUDA graph replays a fixed single process step, so the train loader must drop its
+    # last partial batch (see prepare_dataloader).
+    if use_cuda_graph:
+        assert hasattr(torch.cuda, "graph"), "CUDA graphs require PyTorch 1.10 or later."
+        assert accum_steps == 1 and not dist.is_initialized(), \
+            "CUDA graph capture does not support gradient accumulation or DDP."
+        # The loaders of prepare_dataloader wrap their sampler in a BatchSampler.
+        assert getattr(train_loader.sampler, "drop_last", False) or train_loader.drop_last, \
+            "CUDA graph capture needs a train loader with drop_last=True."
+
     criterion = nn.CrossEntropyLoss()
 
     model.to(device)
+    # NHWC lets cuDNN pick the Tensor Core conv kernels, especially together with AMP.
+    memory_format = torch.channels_last if channels_last else torch.contiguous_format
+    model.to(memory_format=memory_format)
+
+    # Mixed precision only applies on CUDA devices. Master weights stay in FP32,
+    # the forward pass and loss run in FP16 where it is safe to do so.
+    amp_enabled = use_amp and device.type == "cuda"
+    scaler = torch.cuda.amp.GradScaler(enabled=amp_enabled)
+
+    # The compiled forward is only used for training. The returned and evaluated model stays
+    # the original module so that its state_dict keys are unchanged.
+    # Gradients are all-reduced by DDP, overlapping with the backward pass.
+    ddp_model = DDP(model, device_ids=[device.index]) if dist.is_initialized() else None
+    forward_model = ddp_model if ddp_model is not None else model
+    # A captured CUDA graph already removes the per kernel launch overhead.
+    if use_compile and not use_cuda_graph:
+        forward_model = compile_model(forward_model)
 
     # It seems that SGD optimizer is better than Adam optimizer for ResNet18 training on CIFAR10.
-    optimizer = optim.SGD(model.parameters(),
+    # Only pass trainable parameters so that frozen ones are skipped by optimizer.step().
+    optimizer = optim.SGD([param for param in model.parameters() if param.requires_grad],
                           lr=learning_rate,
                           momentum=0.9,
                           weight_decay=1e-4)
@@ -160,100 +485,251 @@ def train_model(model,
     # optimizer = optim.Adam(model.parameters(), lr=learning_rate, betas=(0.9, 0.999), eps=1e-08, weight_decay=0, amsgrad=False)
 
     # Evaluation
-    model.eval()
-    eval_loss, eval_accuracy = evaluate_model(model=model,
-                                              test_loader=test_loader,
-                                              device=device,
-                                              criterion=criterion)
-    logging.info("Epoch: {:03d} Eval Loss: {:.3f} Eval Acc: {:.3f}".format(
-        0, eval_loss, eval_accuracy))
+    # Only the main process evaluates and logs. Evaluation issues no collectives, and the
+    # other ranks would only repeat the same full test set pass.
+    if is_main_process():
+        model.eval()
+        eval_loss, eval_accuracy = evaluate_model(model=model,
+                                                  test_loader=test_loader,
+                                                  device=device,
+                                                  criterion=criterion,
+                                                  use_amp=use_amp,
+                                                  normalizer=normalizer,
+                                                  channels_last=channels_last)
+        logging.info("Epoch: {:03d} Eval Loss: {:.3f} Eval Acc: {:.3f}".format(
+            0, eval_loss, eval_accuracy))
+
+    train_graph = None
 
     for epoch in range(num_epochs):
 
         # Training
         model.train()
-
-        running_loss = 0
-        running_corrects = 0
-
-        for inputs, labels in train_loader:
-
-            inputs = inputs.to(device)
-            labels = labels.to(device)
+        set_frozen_batchnorm_eval(model)
+        # The loaders of prepare_dataloader wrap their sampler in a BatchSampler.
+        train_sampler = getattr(train_loader.sampler, "sampler", train_loader.sampler)
+        if isinstance(train_sampler, torch.utils.data.distributed.DistributedSampler):
+            train_sampler.set_epoch(epoch)
+
+        # Accumulate the statistics on device to avoid a host sync per batch.
+        running_loss = torch.zeros((), device=device)
+        running_corrects = torch.zeros((), device=device, dtype=torch.long)
+        num_samples = 0
+
+        # On CUDA the batches arrive already copied to device by the prefetcher.
+        batches = CUDAPrefetcher(train_loader, device) if device.type == "cuda" else train_loader
+
+        for step, (inputs, labels) in enumerate(batches):
+
+            inputs = inputs.to(device, non_blocking=True)
+            labels = labels.to(device, non_blocking=True)
+            if augment is not None:
+                inputs = augment(inputs)
+            if normalizer is not None:
+                inputs = normalizer(inputs)
+            inputs = inputs.contiguous(memory_format=memory_format)
 
             # print(f'input.shape: {inputs.size()}')
             # print(f'labels.shape: {labels.size()}')
 
 
-            # zero the parameter gradients
-            optimizer.zero_grad()
-
-            # forward + backward + optimize
-            outputs = model(inputs)
-            _, preds = torch.max(outputs, 1)
-            loss = criterion(outputs, labels)
-            loss.backward()
-            optimizer.step()
+            if use_cuda_graph:
+                if train_graph is None:
+                    static_inputs = inputs.clone()
+                    static_labels = labels.clone()
+                    train_graph, static_outputs, static_loss = capture_train_step(
+                        forward_model=forward_model,
+                        criterion=criterion,
+                        optimizer=optimizer,
+                        scaler=scaler,
+                        amp_enabled=amp_enabled,
+                        static_inputs=static_inputs,
+                        static_labels=static_labels)
+
+                # forward + backward, then optimize. The gradients are overwritten by every
+                # replay, so they must not be zeroed (or set to None) between steps.
+                static_inputs.copy_(inputs, non_blocking=True)
+                static_labels.copy_(labels, non_blocking=True)
+                train_graph.replay()
+                outputs, loss = static_outputs, static_loss
+                scaler.step(optimizer)
+                scaler.update()
+            else:
+                # Gradients are accumulated over accum_steps micro-batches. Only the last
+                # micro-batch of each group needs the DDP all-reduce, the others skip it with
+                # no_sync().
+                sync_gradients = (step + 1) % accum_steps == 0 or step + 1 == len(train_loader)
+                # The last group of the epoch may have fewer than accum_steps micro-batches.
+                group_size = min(accum_steps, len(train_loader) - step // accum_steps * accum_steps)
+                if ddp_model is not None and not sync_gradients:
+                    sync_context = ddp_model.no_sync()
+                else:
+                    # No-op context manager. contextlib.nullcontext needs Python 3.7.
+                    sync_context = contextlib.ExitStack()
+
+                # forward + backward + optimize
+                with sync_context:
+                    with torch.cuda.amp.autocast(enabled=amp_enabled):
+                        outputs = forward_model(inputs)
+                        loss = criterion(outputs, labels)
+                    scaler.scale(loss / group_size).backward()
+
+                if sync_gradients:
+                    scaler.step(optimizer)
+                    scaler.update()
+                    # zero the parameter gradients
+                    optimizer.zero_grad(set_to_none=True)
+            preds = outputs.argmax(dim=1)
 
             # statistics
-            running_loss += loss.item() * inputs.size(0)
-            running_corrects += torch.sum(preds == labels.data)
-
-        train_loss = running_loss / len(train_loader.dataset)
-        train_accuracy = running_corrects / len(train_loader.dataset)
+            running_loss += loss.detach() * inputs.size(0)
+            running_corrects += (preds == labels).sum()
+            num_samples += inputs.size(0)
 
-        # Evaluation
-        model.eval()
-        eval_loss, eval_accuracy = evaluate_model(model=model,
-                                                  test_loader=test_loader,
-                                                  device=device,
-                                                  criterion=criterion)
+        if dist.is_initialized():
+            dist.all_reduce(running_loss)
+            dist.all_reduce(running_corrects)
+            num_samples *= dist.get_world_size()
+        train_loss = running_loss.item() / num_samples
+        train_accuracy = running_corrects.item() / num_samples
 
         # Set learning rate scheduler
         scheduler.step()
 
-        logging.info(
-            "Epoch: {:03d} Train Loss: {:.3f} Train Acc: {:.3f} Eval Loss: {:.3f} Eval Acc: {:.3f}"
-            .format(epoch + 1, train_loss, train_accuracy, eval_loss,
-                    eval_accuracy))
+        # Evaluation
+        if is_main_process():
+            model.eval()
+            eval_loss, eval_accuracy = evaluate_model(model=model,
+                                                      test_loader=test_loader,
+                                                      device=device,
+                                                      criterion=criterion,
+                                                      use_amp=use_amp,
+                                                      normalizer=normalizer,
+                                                      channels_last=channels_last)
+            logging.info(
+                "Epoch: {:03d} Train Loss: {:.3f} Train Acc: {:.3f} Eval Loss: {:.3f} Eval Acc: {:.3f}"
+                .format(epoch + 1, train_loss, train_accuracy, eval_loss,
+                        eval_accuracy))
 
     return model
 
 
-def calibrate_model(model, loader, device=torch.device("cpu:0")):
+def calibrate_model(model,
+                    loader,
+                    device=torch.device("cpu:0"),
+                    normalizer=None,
+                    num_batches=None):
 
-    model.to(device)
     model.eval()
 
-    for inputs, labels in loader:
-        inputs = inputs.to(device)
-        labels = labels.to(device)
+    for i, (inputs, labels) in enumerate(loader):
+        inputs = inputs.to(device, non_blocking=True)
+        labels = labels.to(device, non_blocking=True)
+        if normalizer is not None:
+            inputs = normalizer(inputs)
         _ = model(inputs)
+        if num_batches is not None and i + 1 >= num_batches:
+            break
+
+
+def fuse_model(model):
+    """Returns an eval mode copy of a ResNet18 or VovNet model with Conv-BN(-ReLU) fused."""
+
+    fused_model = copy.deepcopy(model)
+    # Fusing in eval mode folds the BN statistics into the conv weights.
+    fused_model.eval()
+
+    if isinstance(fused_model, ResNet):
+        torch.quantization.fuse_modules(fused_model, [["conv1", "bn1", "relu"]],
+                                        inplace=True)
+        for module_name, module in fused_model.named_children():
+            if "layer" in module_name:
+                for basic_block_name, basic_block in module.named_children():
+                    assert isinstance(basic_block, BasicBlock)
+                    torch.quantization.fuse_modules(
+                        basic_block, [["conv1", "bn1", "relu1"], ["conv2", "bn2"]],
+                        inplace=True)
+                    for sub_block_name, sub_block in basic_block.named_children():
+                        if sub_block_name == "downsample":
+                            torch.quantization.fuse_modules(sub_block,
+                                                            [["0", "1"]],
+                                                            inplace=True)
+    elif isinstance(fused_model, VovNet):
+        # See conv3x3, conv1x1 and dw_conv3x3 in vovnet.py for the module names.
+        for module in fused_model.modules():
+            if not isinstance(module, nn.Sequential):
+                continue
+            modules_to_fuse = []
+            for name, _ in module.named_children():
+                if name.endswith("/conv"):
+                    prefix = name[:-len("/conv")]
+                    modules_to_fuse.append(
+                        [prefix + "/conv", prefix + "/norm", prefix + "/relu"])
+                elif name.endswith("/pw_conv1x1"):
+                    prefix = name[:-len("/pw_conv1x1")]
+                    modules_to_fuse.append(
+                        [prefix + "/pw_conv1x1", prefix + "/pw_norm", prefix + "/pw_relu"])
+            if modules_to_fuse:
+                torch.quantization.fuse_modules(module, modules_to_fuse, inplace=True)
+    else:
+        raise NotImplementedError(
+            "Layer fusion is not implemented for {}.".format(type(model).__name__))
+
+    return fused_model
 
 
 def measure_inference_latency(model,
                               device,
                               input_size=(1, 3, 32, 32),
                               num_samples=100,
-                              num_warmups=10):
+                              num_warmups=10,
+                              use_cuda_events=False):
+    """Returns the average time per forward pass in seconds.
+
+    By default the num_samples forward passes are timed as one window with a single
+    synchronization at the end. With use_cuda_events=True on a CUDA device, each forward pass
+    is timed individually with a pair of CUDA events instead.
+
+    The caller owns the device placement of the model, it must already be on device.
+    """
 
-    model.to(device)
     model.eval()
 
     x = torch.rand(size=input_size).to(device)
+    is_cuda = device.type == "cuda"
 
-    with torch.no_grad():
-        for _ in range(num_warmups):
-            _ = model(x)
-    torch.cuda.synchronize()
+    # Make sure the model and input copies are done before warming up (and cuDNN autotuning).
+    if is_cuda:
+        torch.cuda.synchronize(device)
 
     with torch.no_grad():
-        start_time = time.time()
-        for _ in range(num_samples):
+        for _ in range(num_warmups):
             _ = model(x)
-            torch.cuda.synchronize()
-        end_time = time.time()
-    elapsed_time = end_time - start_time
+    if is_cuda:
+        torch.cuda.synchronize(device)
+
+    if is_cuda and use_cuda_events:
+        start_events = [torch.cuda.Event(enable_timing=True) for _ in range(num_samples)]
+        end_events = [torch.cuda.Event(enable_timing=True) for _ in range(num_samples)]
+        with torch.no_grad():
+            for start_event, end_event in zip(start_events, end_events):
+                start_event.record()
+                _ = model(x)
+                end_event.record()
+        torch.cuda.synchronize(device)
+        # Event.elapsed_time is in milliseconds.
+        elapsed_time = sum(
+            start_event.elapsed_time(end_event)
+            for start_event, end_event in zip(start_events, end_events)) / 1000
+    else:
+        with torch.no_grad():
+            start_time = time.time()
+            for _ in range(num_samples):
+                _ = model(x)
+            if is_cuda:
+                torch.cuda.synchronize(device)
+            end_time = time.time()
+        elapsed_time = end_time - start_time
     elapsed_time_ave = elapsed_time / num_samples
 
     return elapsed_time_ave
@@ -335,6 +811,39 @@ class QuantizedResNet18(nn.Module):
         return x
 
 
+def quantize_model(model,
+                   loader,
+                   normalizer=None,
+                   backend="fbgemm",
+                   num_calibration_batches=32):
+    """Returns an INT8 copy of model made by post-training static quantization on CPU.
+
+    The model is fused, wrapped with QuantizedResNet18, calibrated on the first
+    num_calibration_batches batches of loader and converted. backend must match
+    torch.backends.quantized.engine, which the caller sets.
+    Only models whose forward is quantizable in eager mode (e.g. ResNet18) are supported.
+    """
+
+    cpu_device = torch.device("cpu:0")
+    # Static quantization does not support CUDA currently.
+    quantized_model = QuantizedResNet18(model_fp32=fuse_model(model).to(cpu_device))
+    quantized_model.eval()
+    quantized_model.qconfig = torch.quantization.get_default_qconfig(backend)
+    torch.quantization.prepare(quantized_model, inplace=True)
+
+    if normalizer is not None:
+        normalizer = copy.deepcopy(normalizer).to(cpu_device)
+    calibrate_model(model=quantized_model,
+                    loader=loader,
+                    device=cpu_device,
+                    normalizer=normalizer,
+                    num_batches=num_calibration_batches)
+
+    torch.quantization.convert(quantized_model, inplace=True)
+
+    return quantized_model
+
+
 def model_equivalence(model_1,
                       model_2,
                       device,
@@ -375,11 +884,21 @@ def main():
     dataset_name = FASHION_MNIST
     assert dataset_name in (FASHION_MNIST, CIFAR10)
 
-    print(f'Setting: arch={arch}, lr={learning_rate}, finetune={finetune}, finetune_layer_keyword={finetune_layer_keyword}, num_epochs={num_epochs}, dataset={dataset_name}')
+    # Capture the training step with CUDA graphs (single process only).
+    use_cuda_graph = False
+
+    # Launch with torchrun for multi-GPU training, e.g.
+    # torchrun --nproc_per_node=4 cs330_baseline_cifar.py
+    _, local_rank, _ = setup_distributed()
+
+    if is_main_process():
+        print(f'Setting: arch={arch}, lr={learning_rate}, finetune={finetune}, finetune_layer_keyword={finetune_layer_keyword}, num_epochs={num_epochs}, dataset={dataset_name}')
 
     random_seed = 0
+    # Only needed to reproduce a final artifact, it disables the cuDNN autotuner.
+    deterministic = False
     num_classes = 10
-    cuda_device = torch.device("cuda:0")
+    cuda_device = torch.device("cuda", local_rank)
     cpu_device = torch.device("cpu:0")
 
     model_dir = "saved_models"
@@ -393,9 +912,10 @@ def main():
         dot_pos = model_filename.rfind('.')
         assert dot_pos != -1
         model_filename = f'{model_filename[:dot_pos]}_ft_{finetune_layer_keyword}.{model_filename[dot_pos+1:]}'
-        print(f'Finetune dst model_file: {model_filename}')
+        if is_main_process():
+            print(f'Finetune dst model_file: {model_filename}')
 
-    set_random_seeds(random_seed=random_seed)
+    set_random_seeds(random_seed=random_seed, deterministic=deterministic)
 
     # Create an untrained model.
     input_ch = 1 if dataset_name == FASHION_MNIST else 3
@@ -406,30 +926,104 @@ def main():
     # exit()
 
     if finetune:
-        print(f'Loading pre-trained weights from {baseline_model_path}')
-        model.load_state_dict(torch.load(baseline_model_path))
+        if is_main_process():
+            print(f'Loading pre-trained weights from {baseline_model_path}')
+        model.load_state_dict(torch.load(baseline_model_path, map_location=cpu_device))
         for name, param in model.named_parameters():
             if not name.startswith(finetune_layer_keyword):
                 param.requires_grad = False
-            else:
+            elif is_main_process():
                 print(f'Finetune param: {name}')
 
     train_loader, test_loader = prepare_dataloader(num_workers=8,
                                                    train_batch_size=128,
                                                    eval_batch_size=256,
-                                                   dataset=dataset_name)
+                                                   dataset=dataset_name,
+                                                   drop_last=use_cuda_graph)
+
+    mean, std = DATASET_MEAN_STD[dataset_name]
+    normalizer = GPUNormalize(mean=mean, std=std).to(cuda_device)
+    # FashionMNIST is only flipped, CIFAR10 is also randomly cropped.
+    augment = GPUAugment(padding=4 if dataset_name == CIFAR10 else 0, hflip=True)
 
     # Train model.
-    print("Training Model...")
+    if is_main_process():
+        print("Training Model...")
     model = train_model(model=model,
                         train_loader=train_loader,
                         test_loader=test_loader,
                         device=cuda_device,
                         # device=cpu_device,
                         learning_rate=learning_rate,
-                        num_epochs=num_epochs)
+                        num_epochs=num_epochs,
+                        normalizer=normalizer,
+                        augment=augment,
+                        use_cuda_graph=use_cuda_graph)
     # Save model.
-    save_model(model=model, model_dir=model_dir, model_filename=model_filename)
+    if is_main_process():
+        save_model(model=model, model_dir=model_dir, model_filename=model_filename)
+
+        # Fuse Conv+BN(+ReLU) for the FP32 inference paths.
+        fused_model = fuse_model(model)
+        model.eval()
+        # Tolerances are looser than on CPU since cuDNN may run the convs in TF32.
+        assert model_equivalence(
+            model_1=model,
+            model_2=fused_model,
+            device=cuda_device,
+            rtol=1e-02,
+            atol=1e-03,
+            num_tests=100,
+            input_size=(1, input_ch, 32, 32)), "Fused model is not equivalent to the original model!"
+        _, fused_eval_accuracy = evaluate_model(model=fused_model,
+                                                test_loader=test_loader,
+                                                device=cuda_device,
+                                                criterion=None,
+                                                normalizer=normalizer)
+        fused_gpu_inference_latency = measure_inference_latency(
+            model=fused_model,
+            device=cuda_device,
+            input_size=(1, input_ch, 32, 32),
+            num_samples=100)
+        print("Fused FP32 evaluation accuracy: {:.3f}".format(fused_eval_accuracy))
+        print("Fused FP32 CUDA Inference Latency: {:.2f} ms / sample".format(
+            fused_gpu_inference_latency * 1000))
+
+        # VovNet uses float ops (eSE, identity add) that have no eager mode quantized kernels.
+        if arch == 'resnet':
+            # fbgemm for x86 CPUs, qnnpack for ARM CPUs.
+            quantization_backend = "fbgemm"
+            torch.backends.quantized.engine = quantization_backend
+            quantized_model = quantize_model(model=model,
+                                             loader=train_loader,
+                                             normalizer=normalizer,
+                                             backend=quantization_backend,
+                                             num_calibration_batches=32)
+            _, int8_eval_accuracy = evaluate_model(
+                model=quantized_model,
+                test_loader=test_loader,
+                device=cpu_device,
+                criterion=None,
+                normalizer=copy.deepcopy(normalizer).to(cpu_device))
+            fused_model.to(cpu_device)
+            fp32_cpu_inference_latency = measure_inference_latency(
+                model=fused_model,
+                device=cpu_device,
+                input_size=(1, input_ch, 32, 32),
+                num_samples=100)
+            int8_cpu_inference_latency = measure_inference_latency(
+                model=quantized_model,
+                device=cpu_device,
+                input_size=(1, input_ch, 32, 32),
+                num_samples=100)
+            print("INT8 evaluation accuracy: {:.3f}".format(int8_eval_accuracy))
+            print("Fused FP32 CPU Inference Latency: {:.2f} ms / sample".format(
+                fp32_cpu_inference_latency * 1000))
+            print("INT8 CPU Inference Latency: {:.2f} ms / sample".format(
+                int8_cpu_inference_latency * 1000))
+
+    if dist.is_initialized():
+        dist.destroy_process_group()
 
 
 if __name__ == "__main__":